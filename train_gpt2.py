@@ -5,6 +5,11 @@ import numpy as np
 import math
 from dataclasses import dataclass
 
+try:
+    from liger_kernel.transformers import LigerFusedLinearCrossEntropyLoss # fused lm_head + loss, triton/CUDA only
+except ImportError:
+    LigerFusedLinearCrossEntropyLoss = None
+
 
 # @dataclass
 # class GPTConfig:
@@ -20,10 +25,11 @@ class MLP(nn.Module):
         self.c_fc = nn.Linear(config.n_embd, 4*config.n_embd)
         self.gelu = nn.GELU(approximate='tanh')
         self.c_proj = nn.Linear(4*config.n_embd , config.n_embd)
+        self.c_proj._is_residual = True
 
     def forward(self, x):
         x = self.c_fc(x)
-        x = self.gelu(x)
+        x = self.gelu(x) # under torch.compile the c_fc bias add and gelu become one pointwise kernel
         x = self.c_proj(x)
         return x
 
@@ -33,26 +39,21 @@ class CausalSelfAttention(nn.Module):
         assert config.n_embd % config.n_head == 0
         # key, query , values projections for all head but in batch
         self.c_attn = nn.Linear(config.n_embd, 3*config.n_embd)
+        self.c_attn._is_packed_qkv = True
         self.c_proj = nn.Linear(config.n_embd, config.n_embd)
+        self.c_proj._is_residual = True
         self.n_head = config.n_head
         self.n_embd = config.n_embd
-        self.register_buffer("bias", torch.tril(torch.ones(config.block_size , config.block_size)).view(1,1,config.block_size, config.block_size))
 
     def forward(self,x):
         B , T, C  = x.size() # Batch size , sequence length, embedding dimension
         # calculate query, key, values for all heads in batch and move head forward to be the batch dim
         # nh is "number of heads", hs is "head size", and C (number of channels) = nh * hs
         # e.g. in GPT-2 (124M), n_head=12, hs=64, so nh*hs=C=768 channels in the Transformer
-        qkv = self.c_attn(x)
-        q,k,v = qkv.split(self.n_embd, dim=2)
-        q = q.view(B , T, self.n_head, C//self.n_head).transpose(1,2) # (B , nh, T, hs)
-        k = k.view(B , T, self.n_head, C//self.n_head).transpose(1,2) # (B , nh, T, hs)
-        v = v.view(B , T, self.n_head, C//self.n_head).transpose(1,2) # (B , nh, T, hs)
-        att = (q @ k.transpose(-2,-1)) * (1.0 / math.sqrt(k.size(-1)))
-        att = att.masked_fill(self.bias[:,:,:T,:T] == 0, float('-inf'))
-        att = F.softmax(att, dim=-1)
-        y = att @ v # (B , nh , T, T) x (B , nh, T, hs) -> (B, nh, T, hs)
-        y = y.transpose(1, 2).contiguous().view(B , T , C) # re-assemble all head outputs side by side
+        qkv = self.c_attn(x).view(B , T, 3, self.n_head, C//self.n_head).permute(2, 0, 3, 1, 4) # (3, B, nh, T, hs)
+        q, k, v = qkv.unbind(0) # each (B , nh, T, hs)
+        y = F.scaled_dot_product_attention(q, k, v, attn_mask=None, dropout_p=0.0, is_causal=True) # flash attention, (B, nh, T, hs)
+        y = y.transpose(1, 2).reshape(B , T , C) # re-assemble all head outputs side by side, copies only if strides require it
         # output projection
         y = self.c_proj(y)
         return y
@@ -67,8 +68,9 @@ class Block(nn.Module):
         self.mlp = MLP(config)
 
     def forward(self , x):
+        # keep each residual add next to the following layernorm so torch.compile fuses them into one kernel
         x = x + self.attn(self.ln_1(x))
-        x =  x + self.mlp(self.ln_2(x))
+        x = x + self.mlp(self.ln_2(x))
         return x
 
 @dataclass
@@ -93,28 +95,59 @@ class GPT(nn.Module):
             ln_f = nn.LayerNorm(config.n_embd),
         ))
         self.lm_head = nn.Linear(config.n_embd, config.vocab_size, bias=False)
+
+        # weight sharing scheme, the token embedding and the classifier use the same matrix
+        self.lm_head.weight = self.transformer.wte.weight
+        self.fused_ce = LigerFusedLinearCrossEntropyLoss(ignore_index=-1) if LigerFusedLinearCrossEntropyLoss is not None else None
+        # positions are the same every step, build them once and slice per forward
+        self.register_buffer("pos_cache", torch.arange(0, config.block_size, dtype=torch.long), persistent=False)
+
+        # init params
+        self.apply(self._init_weights)
+
+    def _init_weights(self, module):
+        if isinstance(module, nn.Linear):
+            std = 0.02
+            if getattr(module, '_is_residual', False):
+                # scale the projections feeding the residual stream, it accumulates 2 per layer
+                std = 0.02 / math.sqrt(2 * self.config.n_layer)
+            if getattr(module, '_is_packed_qkv', False):
+                # weight stays packed as [3*C, C] so its output views straight into (B, T, 3, nh, hs),
+                # but q, k and v are initialized as separate blocks so each keeps GPT-2 init statistics
+                for w in module.weight.data.split(self.config.n_embd, dim=0):
+                    torch.nn.init.normal_(w, mean=0.0, std=std)
+            else:
+                torch.nn.init.normal_(module.weight, mean=0.0, std=std)
+            if module.bias is not None:
+                torch.nn.init.zeros_(module.bias)
+        elif isinstance(module, nn.Embedding):
+            torch.nn.init.normal_(module.weight, mean=0.0, std=0.02)
     
-    def forward(self, idx , targets=None):
+    def forward(self, idx , targets=None, inference_only=False):
         # idxus is if shape (B, T)
         B , T = idx.size()
         assert T<= self.config.block_size, f"Cannot forward sequence of lenth {T}, block size"
         # forward the token and positition embedding
-        pos = torch.arange(0,T,dtype=torch.long, device=idx.device) # shape (T)
-        pos_emb = self.transformer.wpe(pos) # position embeddings of shape (T , n_embed)
-        tok_emb = self.transformer.wte(idx) # position embeddings of shape (B , T, n_embed)
-        # print(idx.shape)
-        # print(tok_emb.shape)
-        x = pos_emb + tok_emb
+        x = self.transformer.wte(idx) # token embeddings of shape (B , T, n_embed)
+        x = x + self.transformer.wpe(self.pos_cache[:T]) # position embeddings (T , n_embed) broadcast over B, inductor fuses the add
 
         for block in self.transformer.h:
             x = block(x)
         # forward the final layernorm and time classifier
         x = self.transformer.ln_f(x)
-        print(x.shape , "x")
-        logits = self.lm_head(x) # (B , T , vocab_size)
+        if targets is not None and self.fused_ce is not None and x.is_cuda:
+            # project and compute the loss tile by tile, the (B , T , vocab_size) logits are never materialized
+            logits = None
+            loss = self.fused_ce(self.lm_head.weight, x.flatten(0, 1), targets.flatten())
+            return logits , loss
+        if inference_only and targets is None:
+            # generation only needs the last position, skip the vocab projection for the rest
+            logits = self.lm_head(x[:, [-1], :]) # (B , 1 , vocab_size)
+        else:
+            logits = self.lm_head(x) # (B , T , vocab_size)
         loss = None
         if targets is not None:
-            loss = F.cross_entropy(logits.view(-1, logits.size(-1)), targets.view(-1))
+            loss = F.cross_entropy(logits.flatten(0, 1), targets.flatten(), ignore_index=-1)
         return logits , loss
     
     @classmethod
@@ -140,7 +173,8 @@ class GPT(nn.Module):
         model = GPT(config)
         sd = model.state_dict()
         sd_keys = sd.keys()
-        sd_keys = [k for k in sd_keys if not k.endswith('.attn.bias')] # discard this mask / buffer not param
+        # no '.attn.bias' mask buffer to discard here, SDPA builds the causal mask itself
+        sd_keys = [k for k in sd_keys if k != 'lm_head.weight'] # tied to wte.weight, copied through it
 
         model_hf = GPT2LMHeadModel.from_pretrained(model_type)
         sd_hf = model_hf.state_dict()
@@ -149,6 +183,7 @@ class GPT(nn.Module):
         sd_keys_hf = sd_hf.keys()
         sd_keys_hf = [k for k in sd_keys_hf if not k.endswith('.attn.masked_bias')] # ignore these, just a buffer
         sd_keys_hf = [k for k in sd_keys_hf if not k.endswith('.attn.bias')] # same, just the mask (buffer)
+        sd_keys_hf = [k for k in sd_keys_hf if k != 'lm_head.weight'] # hf ties it to wte too
         transposed = ['attn.c_attn.weight', 'attn.c_proj.weight', 'mlp.c_fc.weight', 'mlp.c_proj.weight']
         # basically the openai checkpoints use a "Conv1D" module, but we only want to use a vanilla Linear
         # this means that we have to transpose these weights when we import them
@@ -172,7 +207,7 @@ if torch.cuda.is_available():
 elif hasattr(torch.backends, "mps") and torch.backends.mps.is_available():
     device = 'mps'
 print("using device" , device)
-device = "cpu"
+torch.set_float32_matmul_precision('high') # TF32 for any matmul left in fp32
 # num_return_sequences = 5
 # max_length = 30
 
@@ -187,20 +222,21 @@ with open('input.txt', 'r') as f:
 text = text[:1000]
 tokens = enc.encode(text)
 B, T = 4,32
-buf = torch.tensor(tokens[:B * T + 1])
-buf = buf.to(device)
+buf = torch.tensor(tokens[:B * T + 1], pin_memory=(device == 'cuda')) # pinned so the H2D copy can be async
+buf = buf.to(device, non_blocking=True)
 x = buf[:-1].view(B, T)
 y = buf[1:].view(B , T)
-print("x" , x.shape)
-# print("y" , y)
 
 # get logits
 model = GPT(GPTConfig)
 model.to(device)
-optimizer = torch.optim.AdamW(model.parameters(), lr=3e-4)
+model = torch.compile(model, mode="reduce-overhead") # shapes (B, T) are fixed, so no dynamic guards
+use_fused = device == 'cuda' # fused AdamW kernel is CUDA-only
+optimizer = torch.optim.AdamW(model.parameters(), lr=3e-4, fused=use_fused)
 for i in range(50):
-    optimizer.zero_grad()
-    logits , loss = model(x , y)
+    optimizer.zero_grad(set_to_none=True)
+    with torch.autocast(device_type=device, dtype=torch.bfloat16, enabled=(device == 'cuda')):
+        logits , loss = model(x , y)
     loss.backward()
     optimizer.step()
     print(f"Step {i} , loss {loss.item()}")
@@ -215,7 +251,7 @@ for i in range(50):
 # while x.size(1) < max_length:
 #     with torch.no_grad():
 #         # forward the model to get the logits
-#         logits = model(x)  # (B, T, vocab_size)
+#         logits, _ = model(x, inference_only=True)  # (B, 1, vocab_size)
 #         # take the logits at the last position
 #         logits = logits[:, -1, :]  # B, vocab_size
 #         probs = F.softmax(logits, dim=-1)